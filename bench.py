@@ -0,0 +1,398 @@
+"""Benchmarks of the store, everything runs against a throwaway sqlite database, run them from the project folder:
+
+    python bench.py routes --scale 10k --shoppers 8 --seconds 20
+    python bench.py micro
+    python bench.py search --products 100000
+    python bench.py writes --threads 8 --seconds 10
+    python bench.py oversell --threads 40 --stock 25
+"""
+import argparse
+from datetime import date, timedelta
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event
+
+# dataset sizes: products and orders, there is a user per 10 products
+SCALES = {'1k': 1000, '10k': 10000, '100k': 100000}
+# synthetic vocabulary of a few thousand words, so a word matches a realistic share of the catalog
+SYLLABLES = ['ka', 'lo', 'mi', 're', 'su', 'ta', 'ne', 'vo', 'bi', 'da', 'po', 'ru', 'ze', 'fi', 'go', 'la', 'me', 'xo']
+WORDS = sorted({a + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES})
+
+
+def percentiles(samples):
+    """p50/p95/p99 of samples (seconds) in milliseconds"""
+    q = statistics.quantiles(samples, n=100, method='inclusive')
+    return {'p50': q[49] * 1000, 'p95': q[94] * 1000, 'p99': q[98] * 1000}
+
+
+def report(name, samples, extra=''):
+    p = percentiles(samples)
+    print(f"{name:<32} n={len(samples):<6} p50={p['p50']:9.3f}ms p95={p['p95']:9.3f}ms p99={p['p99']:9.3f}ms{extra}")
+
+
+def timed(func, n):
+    """runs func n times, returns a list of durations"""
+    samples = []
+    for _ in range(n):
+        t = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t)
+    return samples
+
+
+def make_app(folder):
+    """the real app bound to a fresh database in folder, engine settings come from the environment"""
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(folder, 'bench.db')
+    import main
+    main.app.config.update(SECRET_KEY='bench', WTF_CSRF_ENABLED=False, TESTING=True)
+    client = main.app.test_client()
+    # first request creates all tables and indexes
+    client.get('/')
+    return main, client
+
+
+def seed_products(main, n, batch=10000, stock=None):
+    """n products with random names and descriptions made of WORDS, search index included"""
+    rng = random.Random(1)
+    with main.app.app_context():
+        for start in range(0, n, batch):
+            rows = [{'p_category': rng.choice(main.CATS),
+                     'p_name': f'{rng.choice(WORDS)} {rng.choice(WORDS)} {i}',
+                     'p_description': ' '.join(rng.choice(WORDS) for _ in range(12)),
+                     'p_price': rng.randint(1, 500), 'p_amount': stock or rng.randint(0, 100)}
+                    for i in range(start, min(start + batch, n))]
+            main.db.session.execute(main.Product.__table__.insert(), rows)
+            main.db.session.commit()
+        main.reindex_search()
+
+
+def seed_users(main, n):
+    """n users named user<i>, all of them with password 'pw' (hashed once, it's slow on purpose)"""
+    from werkzeug.security import generate_password_hash
+    pw = generate_password_hash('pw', method='pbkdf2:sha256', salt_length=8)
+    with main.app.app_context():
+        main.db.session.execute(main.User.__table__.insert(),
+                                [{'user_name': f'user{i}', 'password': pw, 'u_date': date.today()} for i in range(n)])
+        main.db.session.commit()
+
+
+def seed_orders(main, n, users, products, batch=10000):
+    """n orders of 1-5 lines spread over the last year, rollups included"""
+    rng = random.Random(3)
+    with main.app.app_context():
+        for start in range(0, n, batch):
+            orders, lines = [], []
+            for o_id in range(start + 1, min(start + batch, n) + 1):
+                picked = {rng.randint(1, products): rng.randint(1, 3) for _ in range(rng.randint(1, 5))}
+                prices = {k: rng.randint(1, 500) for k in picked}
+                orders.append({'o_id': o_id, 'o_date': date.today() - timedelta(days=rng.randint(0, 365)), 'o_state': 0,
+                               'u_id': rng.randint(1, users), 'o_total': sum(prices[k] * v for k, v in picked.items()),
+                               'o_qty': sum(picked.values())})
+                lines += [{'o_id': o_id, 'p_id': k, 'l_qty': v, 'l_price': prices[k]} for k, v in picked.items()]
+            main.db.session.execute(main.Order.__table__.insert(), orders)
+            main.db.session.execute(main.OrderLine.__table__.insert(), lines)
+            main.db.session.commit()
+    main.app.test_cli_runner().invoke(args=['rebuild-revenue'])
+
+
+def seed_store(main, scale):
+    """products, users and orders of a SCALES dataset, returns (products, users)"""
+    n = SCALES[scale]
+    products, users = n, max(n // 10, 10)
+    seed_products(main, products, stock=10 ** 9)
+    seed_users(main, users)
+    seed_orders(main, n, users, products)
+    return products, users
+
+
+class QueryCounter:
+    """counts sql statements of the current thread, a request runs in the thread of its test client"""
+    def __init__(self, engine):
+        self.local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.n = getattr(self.local, 'n', 0) + 1
+
+    def take(self):
+        n, self.local.n = getattr(self.local, 'n', 0), 0
+        return n
+
+
+def browse(main, rng, client, products, own):
+    """one random visitor's action, returns its name"""
+    action = rng.choices(['products', 'category', 'item', 'search', 'buy', 'cart', 'checkout', 'orders', 'order'],
+                         [20, 10, 25, 10, 10, 8, 4, 8, 5])[0]
+    if action == 'products':
+        client.get('/products')
+    elif action == 'category':
+        client.get(f'/products?cat={rng.choice(main.CATS)}&sort={rng.choice(main.SORTS)}')
+    elif action == 'item':
+        client.get(f'/products/{rng.randint(1, products)}')
+    elif action == 'search':
+        client.get(f'/search?q={rng.choice(WORDS)}')
+    elif action == 'buy':
+        client.get(f'/buy/{rng.randint(1, products)}')
+    elif action == 'cart':
+        client.get('/cart')
+    elif action == 'checkout':
+        client.get(f'/buy/{rng.randint(1, products)}')
+        client.post('/cart', data={'scrtbtn': '1'})
+        client.post('/checkout', data=CHECKOUT_FORM)
+    elif action == 'orders':
+        client.get('/orders')
+    elif own:
+        client.get(f'/order/{rng.choice(own)}')
+    else:
+        action = 'orders'
+        client.get('/orders')
+    return action
+
+
+def visitor(main, queries, start, i, products, users, results):
+    """logs in as one of the users and keeps browsing until the deadline, results = {action: [(seconds, queries)]}"""
+    client = main.app.test_client()
+    rng = random.Random(i)
+    user = rng.randint(1, users)
+    client.post('/login', data={'username_f': f'user{user - 1}', 'password_f': 'pw'})
+    with main.app.app_context():
+        own = [o for o, in main.db.session.query(main.Order.o_id).filter(main.Order.u_id == user)]
+    start.wait()
+    while time.perf_counter() < start.deadline:
+        queries.take()
+        t = time.perf_counter()
+        action = browse(main, rng, client, products, own)
+        results.setdefault(action, []).append((time.perf_counter() - t, queries.take()))
+
+
+def bench_routes(args):
+    with tempfile.TemporaryDirectory() as folder:
+        main, client = make_app(folder)
+        t = time.perf_counter()
+        products, users = seed_store(main, args.scale)
+        print(f'{args.scale}: {products} products, {users} users, {SCALES[args.scale]} orders seeded '
+              f'in {time.perf_counter() - t:.1f}s')
+        queries = QueryCounter(main.db.engine)
+        start = threading.Barrier(args.shoppers,
+                                  action=lambda: setattr(start, 'deadline', time.perf_counter() + args.seconds))
+        results = [{} for _ in range(args.shoppers)]
+        threads = [threading.Thread(target=visitor, args=(main, queries, start, i, products, users, results[i]))
+                   for i in range(args.shoppers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        total = 0
+        for action in sorted({a for r in results for a in r}):
+            samples = [s for r in results for s in r.get(action, [])]
+            total += len(samples)
+            if len(samples) > 1:
+                report(action, [s for s, _ in samples], f' queries={sum(q for _, q in samples) / len(samples):.1f}')
+        print(f'{args.shoppers} shoppers, {total / args.seconds:.1f} actions/s')
+
+
+def bench_micro(args):
+    with tempfile.TemporaryDirectory() as folder:
+        main, client = make_app(folder)
+        seed_products(main, 1000, stock=10 ** 9)
+        seed_orders(main, 1, 1, 1000)
+        rng = random.Random(4)
+        with main.app.test_request_context('/'):
+            for size in (1, 10, 100):
+                cart = main.hydrate_cart({rng.randint(1, 1000): rng.randint(1, 3) for _ in range(size)})
+                report(f'calc_total ({len(cart)} lines)', timed(lambda: main.calc_total(cart), args.n))
+
+            def buy():
+                # what buy_pr does to a guest's cart
+                cart = main.get_as()
+                p_id = rng.randint(1, 1000)
+                cart[p_id] = cart.get(p_id, 0) + 1
+                main.update_as(t_cart=cart)
+            report('cart mutation', timed(buy, args.n))
+            json_type = main.JsonType()
+            for size in (10, 100):
+                cart = {rng.randint(1, 1000): rng.randint(1, 3) for _ in range(size)}
+                report(f'User.cart save + load ({len(cart)} lines)', timed(
+                    lambda: json_type.process_result_value(json_type.process_bind_param(cart, None), None), args.n))
+            # a cart of a realistic size
+            cart = dict(list(main.get_as().items())[:10])
+            report(f'hydrate_cart ({len(cart)} lines)', timed(lambda: main.hydrate_cart(cart), args.n))
+            o = main.db.session.query(main.Order).get(1)
+            occ = {l.p_id: [main.db.session.query(main.Product).get(l.p_id), l.l_qty, l.l_price] for l in o.o_lines}
+            report(f'render order.html ({len(occ)} lines)',
+                   timed(lambda: main.render_template('order.html', cc=occ, tot=(o.o_total, o.o_qty), o=o), args.n))
+            cart = main.hydrate_cart(cart)
+            pu = main.locate_images(list(cart), 'cart')
+            report(f'render cart.html ({len(cart)} lines)',
+                   timed(lambda: main.render_template('cart.html', cc=cart, pu=pu, tot=main.calc_total(cart)), args.n))
+
+
+def bench_search(args):
+    with tempfile.TemporaryDirectory() as folder:
+        main, client = make_app(folder)
+        t = time.perf_counter()
+        seed_products(main, args.products)
+        print(f'{args.products} products seeded and indexed in {time.perf_counter() - t:.1f}s')
+        rng = random.Random(2)
+        with main.app.app_context():
+            report('search_products (1 word)', timed(lambda: main.search_products(rng.choice(WORDS)), args.n))
+            report('search_products (2 words)',
+                   timed(lambda: main.search_products(f'{rng.choice(WORDS)} {rng.choice(WORDS)}'), args.n))
+            report('search_products (page 20)', timed(lambda: main.search_products(rng.choice(WORDS), 20), args.n))
+            report('suggest_products', timed(lambda: main.suggest_products(rng.choice(WORDS)[:3]), args.n))
+        report('GET /search', timed(lambda: client.get(f'/search?q={rng.choice(WORDS)}'), args.n))
+        report('GET /search/suggest', timed(lambda: client.get(f'/search/suggest?q={rng.choice(WORDS)[:3]}'), args.n))
+
+
+# engine settings of writes benchmark, baseline is how the store used to talk to sqlite
+PROFILES = {
+    'baseline': {'DB_POOL_SIZE': '0', 'SQLITE_JOURNAL_MODE': 'DELETE', 'SQLITE_SYNCHRONOUS': 'FULL',
+                 'SQLITE_MMAP_SIZE': '0', 'SQLITE_CACHE_SIZE': '-2000'},
+    'tuned': {},
+}
+CHECKOUT_FORM = {'firstName': 'B', 'lastName': 'Bench', 'address': 'Street 1', 'address2': '', 'country': 'X',
+                 'state': 'Y', 'zip': '1', 'paymentMethod': 'credit', 'cc-name': 'B', 'cc-number': '1',
+                 'cc-expiration': '1/30', 'cc-cvv': '1'}
+
+
+def shopper(main, name, start, products, samples, errors, reader=False):
+    """registers and then either buys one product after another or keeps reading own orders until deadline,
+    start is a barrier which sets the deadline once everybody has registered"""
+    client = main.app.test_client()
+    client.post('/register', data={'username_f': name, 'password_f': 'pw'})
+    rng = random.Random(name)
+    start.wait()
+    while time.perf_counter() < start.deadline:
+        t = time.perf_counter()
+        try:
+            if reader:
+                ok = client.get('/orders').status_code == 200
+            else:
+                client.get(f'/buy/{rng.randint(1, products)}')
+                client.post('/cart', data={'scrtbtn': '1'})
+                ok = client.post('/checkout', data=CHECKOUT_FORM).status_code == 302
+        except Exception:
+            ok = False
+        if ok:
+            samples.append(time.perf_counter() - t)
+        else:
+            errors.append(name)
+
+
+def bench_writes(args):
+    if args.profile is None:
+        # engine is configured at import time, so every profile needs a process of its own
+        for profile in PROFILES:
+            subprocess.run([sys.executable, __file__, 'writes', '--profile', profile, '--threads', str(args.threads),
+                            '--readers', str(args.readers), '--seconds', str(args.seconds)], check=True)
+        return
+    os.environ.update(PROFILES[args.profile])
+    with tempfile.TemporaryDirectory() as folder:
+        main, client = make_app(folder)
+        seed_products(main, 1000, stock=10 ** 9)
+        print(f'{args.profile}: {args.threads} shoppers and {args.readers} readers for {args.seconds}s, '
+              f'pool {main.db.engine.pool.__class__.__name__}, {main.app.config["SQLITE_PRAGMAS"]}')
+        checkouts, reads, errors = [], [], []
+        # password hashing is slow, registration mustn't eat the measured time
+        start = threading.Barrier(args.threads + args.readers,
+                                  action=lambda: setattr(start, 'deadline', time.perf_counter() + args.seconds))
+        threads = [threading.Thread(target=shopper, args=(main, f's{i}', start, 1000, checkouts, errors))
+                   for i in range(args.threads)]
+        threads += [threading.Thread(target=shopper, args=(main, f'r{i}', start, 1000, reads, errors, True))
+                    for i in range(args.readers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        report('buy + cart + checkout', checkouts)
+        if reads:
+            report('GET /orders', reads)
+        print(f'{len(checkouts) / args.seconds:.1f} checkouts/s, {len(reads) / args.seconds:.1f} reads/s, '
+              f'{len(errors)} failed\n')
+
+
+def last_buyer(main, name, product, qty, start, statuses):
+    """registers, puts qty of a product into the cart and checks out the moment everybody is ready"""
+    client = main.app.test_client()
+    client.post('/register', data={'username_f': name, 'password_f': 'pw'})
+    for _ in range(qty):
+        client.get(f'/buy/{product}')
+    client.post('/cart', data={'scrtbtn': '1'})
+    start.wait()
+    try:
+        statuses.append(client.post('/checkout', data=CHECKOUT_FORM).status_code)
+    except Exception as e:
+        statuses.append(repr(e))
+
+
+def bench_oversell(args):
+    """more shoppers than stock check out at the same moment, none of them may get what isn't there"""
+    with tempfile.TemporaryDirectory() as folder:
+        main, client = make_app(folder)
+        seed_products(main, args.products, stock=args.stock)
+        print(f'{args.threads} shoppers want {args.qty} of one of {args.products} products, '
+              f'{args.stock} of each in stock')
+        statuses = []
+        start = threading.Barrier(args.threads)
+        threads = [threading.Thread(target=last_buyer,
+                                    args=(main, f's{i}', i % args.products + 1, args.qty, start, statuses))
+                   for i in range(args.threads)]
+        t = time.perf_counter()
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        print(f'{statuses.count(302)} orders, {statuses.count(409)} out of stock (409), '
+              f'{len(statuses) - statuses.count(302) - statuses.count(409)} other in {time.perf_counter() - t:.1f}s')
+        problems = [f'unexpected response {s}' for s in statuses if s not in (302, 409)]
+        with main.app.app_context():
+            sold = dict(main.db.session.query(main.OrderLine.p_id, main.func.sum(main.OrderLine.l_qty))
+                        .group_by(main.OrderLine.p_id).all())
+            for p_id, left in main.db.session.query(main.Product.p_id, main.Product.p_amount):
+                print(f'product {p_id}: {sold.get(p_id, 0)} sold, {left} left')
+                if left < 0 or args.stock - left != sold.get(p_id, 0):
+                    problems.append(f'product {p_id}: stock {args.stock}, {left} left but {sold.get(p_id, 0)} sold')
+            orders = main.db.session.query(main.Order).count()
+            if orders != statuses.count(302):
+                problems.append(f'{orders} orders but {statuses.count(302)} successful checkouts')
+        if problems:
+            sys.exit('OVERSOLD:\n  ' + '\n  '.join(problems))
+        print('no oversell')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('routes', help='latency and queries of real routes under concurrent shoppers')
+    p.add_argument('--scale', choices=SCALES, default='10k')
+    p.add_argument('--shoppers', type=int, default=8)
+    p.add_argument('--seconds', type=float, default=20)
+    p.set_defaults(func=bench_routes)
+    p = commands.add_parser('micro', help='calc_total, cart mutation and template rendering')
+    p.add_argument('-n', type=int, default=2000, help='calls per case')
+    p.set_defaults(func=bench_micro)
+    p = commands.add_parser('search', help='full-text search and autocomplete latency')
+    p.add_argument('--products', type=int, default=100000)
+    p.add_argument('-n', type=int, default=200, help='queries per case')
+    p.set_defaults(func=bench_search)
+    p = commands.add_parser('writes', help='checkout throughput under concurrent writers, baseline vs tuned sqlite')
+    p.add_argument('--threads', type=int, default=8, help='concurrent shoppers')
+    p.add_argument('--readers', type=int, default=4, help='concurrent readers of order history')
+    p.add_argument('--seconds', type=float, default=10)
+    p.add_argument('--profile', choices=PROFILES, help='run just one profile (default: all of them)')
+    p.set_defaults(func=bench_writes)
+    p = commands.add_parser('oversell', help='simultaneous checkouts of more than there is in stock, fails on oversell')
+    p.add_argument('--threads', type=int, default=40, help='concurrent shoppers, all of them check out at once')
+    p.add_argument('--products', type=int, default=1)
+    p.add_argument('--stock', type=int, default=25, help='units of each product')
+    p.add_argument('--qty', type=int, default=1, help='units each shopper wants')
+    p.set_defaults(func=bench_oversell)
+    args = parser.parse_args()
+    args.func(args)